@@ -19,6 +19,7 @@ class ABB_Meter(device.CustomName, device.EnergyMeter):
     vendor_name = 'ABB'
     productid = 0xb033
     min_timeout = 0.5
+    inplace_role_switch = False     # data registers depend on the role
 
     def device_init(self):
         self.info_regs = [
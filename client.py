@@ -1,16 +1,48 @@
+import collections
+import json
+import multiprocessing
 import os
+import select
+import socket
 import struct
+import termios
 import threading
 import time
 
 from pymodbus.client.sync import *
+from pymodbus.exceptions import ConnectionException, ModbusIOException
+from pymodbus.register_read_message import *
 from pymodbus.utilities import computeCRC
 
+CAPTURE_SIZE = 1000
+UDP_RETRIES = 3
+UDP_RESEND_MIN = 0.02
+
+capture_on = False
+
 class ModbusExtras:
+    pipeline = False
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.refcount = 1
         self.in_transaction = False
+        self.lock = threading.RLock()
+        self.frames = collections.deque(maxlen=CAPTURE_SIZE)
+
+    def capture(self, direction, data):
+        self.frames.append((time.time(), direction, bytes(data)))
+
+    def _send(self, data):
+        if capture_on:
+            self.capture('tx', data)
+        return super()._send(data)
+
+    def _recv(self, size):
+        data = super()._recv(size)
+        if capture_on and data:
+            self.capture('rx', data)
+        return data
 
     def get(self):
         self.refcount += 1
@@ -20,18 +52,44 @@ class ModbusExtras:
         if self.refcount > 0:
             self.refcount -= 1
         if self.refcount == 0:
+            self.release_frames()
             self.close()
 
+    # Keep frames captured by a client no longer in use for the next
+    # capture_stop().
+    def release_frames(self):
+        if capture_on:
+            closed_frames.extend((t, str(self), d, data)
+                                 for t, d, data in self.frames)
+        self.frames.clear()
+
     def close(self):
         if self.refcount == 0 or self.in_transaction:
             super().close()
 
     def execute(self, *args):
+        with self.lock:
+            try:
+                self.in_transaction = True
+                return super().execute(*args)
+            finally:
+                self.in_transaction = False
+
+    def __enter__(self):
+        self.lock.acquire()
+
         try:
-            self.in_transaction = True
-            return super().execute(*args)
-        finally:
-            self.in_transaction = False
+            return super().__enter__()
+        except:
+            self.lock.release()
+            raise
+
+    def __exit__(self, *args):
+        super().__exit__(*args)
+        self.lock.release()
+
+    def is_ready(self):
+        return True
 
     def read_registers(self, address, count, access, **kwargs):
         if access == 'holding':
@@ -42,11 +100,174 @@ class ModbusExtras:
 
         raise Exception('Invalid register access type: %s' % access)
 
-class TcpClient(ModbusExtras, ModbusTcpClient):
+    def read_request(self, address, count, access, **kwargs):
+        if access == 'holding':
+            return ReadHoldingRegistersRequest(address, count, **kwargs)
+
+        if access == 'input':
+            return ReadInputRegistersRequest(address, count, **kwargs)
+
+        raise Exception('Invalid register access type: %s' % access)
+
+    def readwrite_request(self, address, count, waddr, values, **kwargs):
+        return ReadWriteMultipleRegistersRequest(read_address=address,
+                                                 read_count=count,
+                                                 write_address=waddr,
+                                                 write_registers=values,
+                                                 **kwargs)
+
+CONNECT_TIMEOUT = 0.5           # upper bound, connect runs in the main loop
+KEEPALIVE = (5, 1, 3)           # idle, interval, count
+
+class SocketClient(ModbusExtras):
+    connect_timeout = CONNECT_TIMEOUT
+    nodelay = True
+    keepalive = KEEPALIVE
+    pool_key = None
+
+    def configure(self, **kwargs):
+        for k, v in kwargs.items():
+            if not hasattr(SocketClient, k) or k == 'pool_key':
+                raise Exception('Invalid transport option: %s' % k)
+            setattr(self, k, v)
+
+    def configure_socket(self):
+        pass
+
+    def put(self):
+        with net_lock:
+            super().put()
+            key = self.pool_key
+            if self.refcount == 0 and net_clients.get(key) is self:
+                del net_clients[key]
+
+class TcpClient(SocketClient, ModbusTcpClient):
     method = 'tcp'
 
-class UdpClient(ModbusExtras, ModbusUdpClient):
+    def connect(self):
+        if self.socket:
+            return True
+
+        try:
+            self.socket = socket.create_connection(
+                (self.host, self.port),
+                timeout=min(self.connect_timeout or self.timeout,
+                            self.timeout),
+                source_address=self.source_address)
+            self.configure_socket()
+        except socket.error:
+            self.close()
+
+        return self.socket is not None
+
+    # Disable Nagle so requests go out immediately, and let the kernel
+    # drop half-open connections after idle + interval * count seconds
+    # of silence rather than waiting for the response timeout to expire
+    # on every request.
+    def configure_socket(self):
+        s = self.socket
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.nodelay))
+
+        if not self.keepalive:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 0)
+            return
+
+        idle, intvl, cnt = self.keepalive
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, intvl)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, cnt)
+
+        if hasattr(socket, 'TCP_USER_TIMEOUT'):
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT,
+                         1000 * (idle + intvl * cnt))
+
+    def execute_many(self, requests):
+        with self.lock:
+            try:
+                self.in_transaction = True
+                return self.pipeline_requests(requests)
+            finally:
+                self.in_transaction = False
+
+    # Send all requests at once, then collect the responses in any
+    # order, matching them by MBAP transaction id.  Requests without
+    # a response before the timeout get a ModbusIOException, and the
+    # connection is closed so late responses are not mistaken for
+    # those of later requests.
+    def pipeline_requests(self, requests):
+        if not self.connect():
+            raise ConnectionException('Failed to connect[%s]' % self)
+
+        pending = {}
+        packet = b''
+
+        for req in requests:
+            req.transaction_id = self.transaction.getNextTID()
+            pending[req.transaction_id] = req
+            packet += self.framer.buildPacket(req)
+
+        # pymodbus leaves the socket non-blocking after a receive
+        self.socket.settimeout(self.timeout)
+
+        try:
+            while packet:
+                packet = packet[self._send(packet):]
+        except socket.error:
+            self.close()
+            raise ConnectionException('Error sending to %s' % self)
+
+        resp = {}
+        data = b''
+        end = time.time() + self.timeout
+
+        while len(resp) < len(pending):
+            now = time.time()
+            if now >= end:
+                break
+
+            ready = select.select([self.socket], [], [], end - now)
+            if not ready[0]:
+                break
+
+            buf = self.socket.recv(4096)
+            if not buf:
+                self.close()
+                break
+
+            if capture_on:
+                self.capture('rx', buf)
+
+            data += buf
+
+            while len(data) >= 8:
+                tid, pid, size = struct.unpack('>HHH', data[:6])
+                if len(data) < 6 + size:
+                    break
+
+                unit = data[6]
+                pdu = data[7:6 + size]
+                data = data[6 + size:]
+
+                if tid not in pending or tid in resp:
+                    continue
+
+                r = self.framer.decoder.decode(pdu)
+                if r:
+                    r.transaction_id = tid
+                    r.unit_id = unit
+                    resp[tid] = r
+
+        if len(resp) < len(pending):
+            self.close()
+
+        return [resp.get(r.transaction_id) or
+                ModbusIOException('No response received', r.function_code)
+                for r in requests]
+
+class UdpClient(SocketClient, ModbusUdpClient):
     method = 'udp'
+    rtt = None
 
     @property
     def timeout(self):
@@ -58,10 +279,84 @@ class UdpClient(ModbusExtras, ModbusUdpClient):
         if self.socket:
             self.socket.settimeout(t)
 
+    def execute(self, request=None):
+        with self.lock:
+            try:
+                self.in_transaction = True
+                if not self.connect():
+                    raise ConnectionException('Failed to connect[%s]' % self)
+                return self.transact(request)
+            finally:
+                self.in_transaction = False
+
+    # Resend a read request up to UDP_RETRIES times when no response
+    # arrives within twice the mean round trip time, and only accept a
+    # response matching the transaction id, so a lost datagram costs
+    # little more than a round trip and late or duplicate responses to
+    # earlier requests are dropped.  Other requests are sent once.
+    def resend_interval(self, request):
+        if request.function_code not in (3, 4) or not self.rtt:
+            return self.timeout
+
+        return max(2 * self.rtt, UDP_RESEND_MIN)
+
+    # round trip time of responses to requests sent only once
+    def update_rtt(self, t):
+        if self.rtt is None:
+            self.rtt = t
+        else:
+            self.rtt += (t - self.rtt) / 8
+
+    def transact(self, request):
+        request.transaction_id = self.transaction.getNextTID()
+        packet = self.framer.buildPacket(request)
+
+        interval = self.resend_interval(request)
+        start = time.time()
+        end = start + self.timeout
+        resend = 0
+        sent = 0
+
+        while True:
+            now = time.time()
+            if now >= end:
+                break
+
+            if now >= resend:
+                self._send(packet)
+                sent += 1
+                resend = now + interval if sent <= UDP_RETRIES else end
+
+            r, _, _ = select.select([self.socket], [], [],
+                                    min(resend, end) - now)
+            if not r:
+                continue
+
+            data = self._recv(1024)
+            if len(data) < 8:
+                continue
+
+            tid, pid, size = struct.unpack('>HHH', data[:6])
+            if tid != request.transaction_id or data[6] != request.unit_id:
+                continue
+
+            resp = self.framer.decoder.decode(data[7:6 + size])
+            if resp:
+                if sent == 1:
+                    self.update_rtt(time.time() - start)
+                resp.transaction_id = tid
+                resp.unit_id = data[6]
+                return resp
+
+        return ModbusIOException('No response received', request.function_code)
+
 class SerialClient(ModbusExtras, ModbusSerialClient):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.lock = threading.RLock()
+        self.lock = port_locks.get(os.path.basename(self.port)) or \
+            threading.RLock()
+        self.ready = threading.Event()
+        self.ready.set()
 
     @property
     def timeout(self):
@@ -78,26 +373,276 @@ class SerialClient(ModbusExtras, ModbusSerialClient):
         if self.refcount == 0:
             del serial_ports[os.path.basename(self.port)]
 
+    def is_ready(self):
+        return self.ready.is_set()
+
     def execute(self, request=None):
-        with self.lock:
-            return super().execute(request)
+        self.ready.wait()
+        return super().execute(request)
 
     def __enter__(self):
-        self.lock.acquire()
+        self.ready.wait()
         return super().__enter__()
 
-    def __exit__(self, *args):
-        super().__exit__(*args)
-        self.lock.release()
+class RtuPort:
+    def __init__(self, dev, rate):
+        self.fd = os.open(dev, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        self.timeout = None
+
+        try:
+            speed = getattr(termios, 'B%d' % rate)
+            attr = termios.tcgetattr(self.fd)
+            cc = attr[6]
+            cc[termios.VMIN] = 0
+            cc[termios.VTIME] = 0
+            cflag = termios.CS8 | termios.CREAD | termios.CLOCAL
+            termios.tcsetattr(self.fd, termios.TCSANOW,
+                              [0, 0, cflag, 0, speed, speed, cc])
+            termios.tcflush(self.fd, termios.TCIOFLUSH)
+        except:
+            os.close(self.fd)
+            raise
+
+    def close(self):
+        os.close(self.fd)
+
+    def write(self, data):
+        while data:
+            select.select([], [self.fd], [])
+            n = os.write(self.fd, data)
+            data = data[n:]
+
+    # Read until size bytes have arrived, the end time has passed or,
+    # if idle is given, the line has been silent for that long.
+    def read(self, size, end, idle=None):
+        buf = b''
+
+        while len(buf) < size:
+            wait = end - time.time()
+            if idle and buf:
+                wait = min(wait, idle)
+            if wait <= 0:
+                break
+
+            r, _, _ = select.select([self.fd], [], [], wait)
+            if not r:
+                break
+
+            buf += os.read(self.fd, size - len(buf))
+
+        return buf
+
+    def drain(self):
+        termios.tcdrain(self.fd)
+
+    def flush_input(self):
+        termios.tcflush(self.fd, termios.TCIFLUSH)
+
+class RtuClient(SerialClient):
+    enabled = False
+
+    def __init__(self, **kwargs):
+        super().__init__('rtu', **kwargs)
+        self.last_frame_end = 0
+
+    def connect(self):
+        if self.socket:
+            return True
+
+        try:
+            self.socket = RtuPort(self.port, self.baudrate)
+        except (OSError, AttributeError, termios.error):
+            self.close()
+
+        return self.socket is not None
+
+    def execute(self, request=None):
+        self.ready.wait()
+
+        with self.lock:
+            try:
+                self.in_transaction = True
+                if not self.connect():
+                    raise ConnectionException('Failed to connect[%s]' % self)
+                return self.transact(request)
+            finally:
+                self.in_transaction = False
+
+    def transact(self, request):
+        gap = frame_gap(self.baudrate)
+        fc = request.function_code
+
+        delay = self.last_frame_end + gap - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        request.transaction_id = 0
+        packet = self.framer.buildPacket(request)
+
+        self.socket.flush_input()
+        self.socket.write(packet)
+        self.socket.drain()
+
+        if capture_on:
+            self.capture('tx', packet)
+
+        end = time.time() + self.timeout
+        size = request.get_response_pdu_size()
+
+        frame = self.socket.read(2, end)
+        crc = crc16(frame)
+
+        if len(frame) < 2:
+            self.last_frame_end = time.time()
+            if capture_on and frame:
+                self.capture('rx', frame)
+            return ModbusIOException('No response received', fc)
+
+        if frame[1] & 0x80:
+            rest = self.socket.read(3, end)
+        elif size:
+            rest = self.socket.read(size + 1, end)
+        else:
+            rest = self.socket.read(256, end, gap)
+
+        crc = crc16(rest, crc)
+        frame += rest
+        self.last_frame_end = time.time()
+
+        if capture_on:
+            self.capture('rx', frame)
+
+        if crc != 0 or len(frame) < 5:
+            return ModbusIOException('Invalid response: %s' % frame.hex(), fc)
+
+        if frame[0] != request.unit_id:
+            return ModbusIOException('Response from unit %d' % frame[0], fc)
+
+        r = self.framer.decoder.decode(frame[1:-2])
+        if not r:
+            return ModbusIOException('Unable to decode response', fc)
+
+        r.unit_id = frame[0]
+        r.transaction_id = 0
+        return r
+
+def make_crc16_table():
+    tab = []
+
+    for i in range(256):
+        c = i
+        for j in range(8):
+            c = (c >> 1) ^ 0xa001 if c & 1 else c >> 1
+        tab.append(c)
+
+    return tab
+
+crc16_table = make_crc16_table()
+
+# Modbus CRC, updated incrementally.  A frame including its CRC
+# yields zero.
+def crc16(data, crc=0xffff):
+    for b in data:
+        crc = (crc >> 8) ^ crc16_table[(crc ^ b) & 0xff]
+    return crc
+
+def char_time(rate):
+    return 11 / rate            # start + 8 data + parity/stop + stop
+
+def frame_gap(rate):
+    # Modbus RTU t3.5, fixed above 19200 bps
+    if rate > 19200:
+        return 0.00175
+    return 3.5 * char_time(rate)
+
+def frame_time(method, rate, nreq, nresp):
+    if method == 'ascii':
+        nreq = 2 * nreq + 3
+        nresp = 2 * nresp + 3
+
+    return (nreq + nresp) * char_time(rate) + 2 * frame_gap(rate)
+
+net_clients = {}
+net_lock = threading.Lock()
 
 serial_ports = {}
+port_locks = {}
+
+# serial ports kept open by the parent of a scan process, tty -> rate
+parent_ports = {}
+
+mp_context = multiprocessing.get_context('forkserver')
+
+# Replace the lock of a serial port with one that can be shared with
+# a child process.  Must be called before starting the child and while
+# the current lock is not held by another thread.
+def share_port_lock(tty):
+    if tty not in port_locks:
+        port_locks[tty] = mp_context.RLock()
+        if tty in serial_ports:
+            serial_ports[tty].lock = port_locks[tty]
+
+    return port_locks[tty]
+
+closed_frames = collections.deque(maxlen=CAPTURE_SIZE)
+
+def all_clients():
+    return list(net_clients.values()) + list(serial_ports.values())
 
-def make_client(m):
-    if m.method == 'tcp':
-        return TcpClient(m.target, m.port)
+def capture_start():
+    global capture_on
 
-    if m.method == 'udp':
-        return UdpClient(m.target, m.port)
+    for c in all_clients():
+        c.frames.clear()
+
+    closed_frames.clear()
+
+    capture_on = True
+
+# Stop capturing and write the frames captured by all clients, open
+# or closed during the capture, to a file, one JSON object per line,
+# in time order.
+def capture_stop(path):
+    global capture_on
+    capture_on = False
+
+    frames = list(closed_frames)
+    closed_frames.clear()
+
+    for c in all_clients():
+        frames += [(t, str(c), d, data) for t, d, data in c.frames]
+        c.frames.clear()
+
+    frames.sort(key=lambda f: f[0])
+
+    with open(path, 'w') as f:
+        for t, name, d, data in frames:
+            rec = {'time': t, 'transport': name, 'dir': d, 'data': data.hex()}
+            f.write(json.dumps(rec) + '\n')
+
+    return len(frames)
+
+# Clients of network devices are shared by all units at an address
+# using the same transport options, e.g. behind a gateway.
+def make_client(m, transport=None):
+    if m.method in ('tcp', 'udp'):
+        opts = tuple(sorted((transport or {}).items()))
+        key = (m.method, m.target, m.port, opts)
+
+        with net_lock:
+            if key in net_clients:
+                return net_clients[key].get()
+
+            if m.method == 'tcp':
+                client = TcpClient(m.target, m.port)
+            else:
+                client = UdpClient(m.target, m.port)
+
+            client.configure(**dict(opts))
+            client.pool_key = key
+            net_clients[key] = client
+
+        return client
 
     tty = m.target
 
@@ -108,20 +653,39 @@ def make_client(m):
         return client.get()
 
     dev = '/dev/%s' % tty
-    client = SerialClient(m.method, port=dev, baudrate=m.rate)
+
+    if m.method == 'rtu' and RtuClient.enabled:
+        client = RtuClient(port=dev, baudrate=m.rate)
+    else:
+        client = SerialClient(m.method, port=dev, baudrate=m.rate)
+
     if not client.connect():
         client.put()
         return None
 
     serial_ports[tty] = client
 
+    # devices on a port the parent is polling are already in sync
+    if parent_ports.get(tty) != m.rate:
+        client.ready.clear()
+        t = threading.Thread(target=warm_up, args=(client.get(),))
+        t.daemon = True
+        t.start()
+
+    return client
+
+def warm_up(client):
     # send some harmless messages to the broadcast address to
     # let rate detection in devices adapt
     packet = bytes([0x00, 0x08, 0x00, 0x00, 0x55, 0x55])
     packet += struct.pack('>H', computeCRC(packet))
 
-    for i in range(12):
-        client.socket.write(packet)
-        time.sleep(0.1)
+    try:
+        for i in range(12):
+            client.socket.write(packet)
+            time.sleep(0.1)
+    except:
+        pass
 
-    return client
+    client.ready.set()
+    client.put()
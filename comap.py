@@ -128,12 +128,12 @@ class ComAp_Generator(device.Genset):
     def _start_genset(self, path, value):
         # This is documented in the Comap global manual, page 204.
         # You need to write the relevant coil to stop/start the genset.
-        if value:
-            self.modbus.write_coil(4700, True, unit=self.unit)
-        else:
-            self.modbus.write_coil(4700, False, unit=self.unit)
+        return self.defer_write(self._write_start, bool(value))
 
-        return True
+    def _write_start(self, value):
+        rr = self.modbus.write_coil(4700, value, unit=self.unit)
+        if rr.isError():
+            self.log.error('Error writing coil 4700: %s', rr)
 
 models = {
     'InteliLite4-': { # InteliLite4-
@@ -174,12 +174,11 @@ class CRE_Compact_Generator(device.CustomName, device.ErrorId, device.Genset):
         # Remote start on load [4502]
         # Activation will start generator in automatic mode and close
         # the generator breaker on load
-        self.write_modbus(4502, [bool(value)])
-        return True
+        return self.defer_write(self.write_modbus, 4502, [bool(value)])
 
     def _set_remote_start_mode(self, _, value):
         if value == 1:
-            self.write_modbus(4513, [1])
+            self.defer_write(self.write_modbus, 4513, [1])
         return False
 
 models = {
@@ -119,8 +119,7 @@ class Datakom_Generator(device.CustomName, device.Genset):
 
     def _start_genset(self, _, value):
         v = 18 if value else 4
-        self.write_modbus(8193, [v])
-        return True
+        return self.defer_write(self.write_modbus, 8193, [v])
 
 models = {
     0xd300: {
@@ -17,10 +17,12 @@ sys.path.insert(1, os.path.join(os.path.dirname(__file__), 'ext', 'velib_python'
 from settingsdevice import SettingsDevice
 from vedbus import VeDbusService
 
+from client import RtuClient, TcpClient, capture_start, capture_stop
 import device
 import devspec
 import mdns
 import probe
+import profiler
 from scan import *
 from utils import *
 import watchdog
@@ -50,11 +52,20 @@ pymodbus.constants.Defaults.Timeout = 0.5
 MODBUS_TCP_PORT = 502
 
 FAIL_TIMEOUT = 5
+OFFLINE_TIMEOUT = 300
+RETRY_INTERVAL_MIN = 1
+RETRY_INTERVAL_MAX = 60
 FAILED_INTERVAL = 10
 MDNS_CHECK_INTERVAL = 5
 MDNS_QUERY_INTERVAL = 60
 SCAN_INTERVAL = 600
+SCAN_CURSOR_INTERVAL = 10
 UPDATE_INTERVAL = 100
+UPDATE_BUDGET = 0.1
+PRIORITY_AGE = 0.5
+
+CAPTURE_PATH = '/tmp/modbus-capture-%s.jsonl'
+PROFILE_PATH = '/tmp/modbus-profile-%s'
 
 if_blacklist = [
     'ap0',
@@ -63,11 +74,20 @@ if_blacklist = [
 def percent(path, val):
     return '%d%%' % val
 
+def signal_toggle(toggle):
+    toggle()
+    return True
+
 class Device:
     def __init__(self, d, nosave):
         self.d = d
         self.nosave = nosave
         self.last_seen = time.time()
+        self.last_poll = 0
+        self.starved = False
+        self.offline = False
+        self.retry_time = 0
+        self.retry_interval = RETRY_INTERVAL_MIN
 
     def __eq__(self, other):
         return str(self) == str(other)
@@ -84,21 +104,35 @@ class Client:
         self.devices = []
         self.failed = []
         self.failed_time = 0
+        self.pending = []
+        self.scan_deferred = False
         self.scanner = None
         self.scan_time = time.time()
+        self.scan_cursor_time = 0
         self.auto_scan = False
         self.err_exit = False
         self.keep_failed = True
+        self.scan_process = False
+        self.capture = False
+        self.profiler = profiler.Profiler()
         self.svc = None
         self.watchdog = watchdog.Watchdog()
 
-    def start_scan(self, full=False):
+    # Only the scan started along with the service continues where an
+    # interrupted scan stopped.  Any other scan starts from the beginning.
+    def start_scan(self, full=False, resume=False):
         if self.scanner:
             return
 
         log.info('Starting background scan')
 
         s = self.new_scanner(full)
+        s.use_process = self.scan_process
+
+        if resume:
+            s.resume = self.settings['scancursor'] or None
+        else:
+            self.settings['scancursor'] = ''
 
         if s.start():
             self.scanner = s
@@ -124,6 +158,17 @@ class Client:
 
         self.save_devices()
 
+    def save_scan_cursor(self, force=False):
+        cursor = self.scanner.cursor or ''
+        now = time.time()
+
+        if cursor == self.settings['scancursor']:
+            return
+
+        if force or now - self.scan_cursor_time > SCAN_CURSOR_INTERVAL:
+            self.settings['scancursor'] = cursor
+            self.scan_cursor_time = now
+
     def scan_complete(self):
         self.scan_time = time.time()
 
@@ -138,6 +183,60 @@ class Client:
 
         return True
 
+    def set_capture(self, on):
+        if on == self.capture:
+            return
+
+        self.capture = on
+
+        if on:
+            capture_start()
+            log.info('Modbus capture started')
+            return
+
+        path = CAPTURE_PATH % self.name
+
+        try:
+            n = capture_stop(path)
+            log.info('Wrote %d captured frames to %s', n, path)
+        except OSError as ex:
+            log.error('Error writing capture: %s', ex)
+
+    def toggle_capture(self):
+        self.set_capture(not self.capture)
+        if self.svc:
+            self.svc['/Capture'] = int(self.capture)
+
+    def dbus_set_capture(self, path, val):
+        self.set_capture(bool(val))
+        return True
+
+    def set_profile(self, on):
+        if on == self.profiler.running:
+            return
+
+        if on:
+            self.profiler.start()
+            log.info('Profiling started')
+            return
+
+        path = PROFILE_PATH % self.name
+
+        try:
+            self.profiler.stop(path)
+            log.info('Wrote profile to %s.txt', path)
+        except OSError as ex:
+            log.error('Error writing profile: %s', ex)
+
+    def toggle_profile(self):
+        self.set_profile(not self.profiler.running)
+        if self.svc:
+            self.svc['/Profile'] = int(self.profiler.running)
+
+    def dbus_set_profile(self, path, val):
+        self.set_profile(bool(val))
+        return True
+
     def init_device(self, dev, nosave=False, enable=True):
         dev.init(self.dbusconn, enable)
         return Device(dev, nosave)
@@ -150,26 +249,108 @@ class Client:
         if not dev.nosave:
             self.failed.append(dev.d.spec)
 
-    def update_device(self, dev):
+    def dev_offline(self, dev):
+        dev.offline = True
+        dev.retry_interval = RETRY_INTERVAL_MIN
+        dev.retry_time = time.time() + dev.retry_interval
+        dev.d.set_connected(False)
+
+    def dev_online(self, dev):
+        dev.d.log.info('Device reconnected')
+        dev.offline = False
+        dev.d.set_connected(True)
+
+    def update_device(self, dev, deadline=None):
+        dev.last_poll = time.time()
+
+        if dev.offline and time.time() < dev.retry_time:
+            return
+
         try:
-            dev.d.update()
+            with self.profiler.device(str(dev)):
+                dev.d.update(deadline)
             dev.last_seen = time.time()
+            if dev.offline:
+                self.dev_online(dev)
         except Exception as ex:
-            if time.time() - dev.last_seen > FAIL_TIMEOUT:
+            now = time.time()
+
+            if now - dev.last_seen > FAIL_TIMEOUT and self.err_exit:
+                dev.d.log.info('Device failed: %s', ex)
+                os._exit(1)
+
+            if now - dev.last_seen > OFFLINE_TIMEOUT:
                 dev.d.log.info('Device failed: %s', ex)
-                if self.err_exit:
-                    os._exit(1)
                 self.dev_failed(dev)
                 self.del_device(dev)
+            elif dev.offline:
+                dev.retry_interval = min(2 * dev.retry_interval,
+                                         RETRY_INTERVAL_MAX)
+                dev.retry_time = now + dev.retry_interval
+            elif now - dev.last_seen > FAIL_TIMEOUT:
+                dev.d.log.info('Device offline, retrying: %s', ex)
+                self.dev_offline(dev)
+
+    # Log when a device only gets polled once promoted to the top class
+    # after the budget is used up, and when it is polled in time again.
+    def check_starved(self, dev, starved):
+        if starved and not dev.starved:
+            dev.d.log.warning('Update budget exceeded, polling less often')
+        elif dev.starved and not starved:
+            dev.d.log.info('Polled within update budget again')
+
+        dev.starved = starved
+
+    # A device waiting for a poll rises one priority class for every
+    # PRIORITY_AGE seconds since its last poll, up to the top class.
+    def poll_priority(self, dev, now, top):
+        age = now - dev.last_poll
+        return max(dev.d.get_priority() - int(age / PRIORITY_AGE), top)
+
+    # Poll devices in priority order, native members of a class before
+    # promoted ones, least recently polled first.  Devices of the top
+    # class are always polled in full.  Once the time budget for this
+    # cycle is used up, other devices below the top class are skipped,
+    # and those still polled only read their most stale register block,
+    # until the next cycle.
+    def update_devices(self):
+        if not self.devices:
+            return
+
+        now = time.time()
+        top = min(d.d.get_priority() for d in self.devices)
+        prio = {id(d): self.poll_priority(d, now, top) for d in self.devices}
+
+        devs = sorted(self.devices,
+                      key=lambda d: (prio[id(d)],
+                                     prio[id(d)] != d.d.get_priority(),
+                                     d.last_poll))
+        deadline = now + UPDATE_BUDGET
+
+        for d in devs:
+            native = d.d.get_priority() == top
+            late = time.time() > deadline
+
+            if prio[id(d)] > top and late and not d.d.write_pending():
+                continue
+
+            if not native:
+                self.check_starved(d, late)
+
+            self.update_device(d, None if native else deadline)
 
     def probe_filter(self, dev):
         return dev not in self.devices
 
     def probe_devices(self, devlist, nosave=False, enable=True):
         devs = set(devlist) - set(self.devices)
-        devs, failed = probe.probe(devs, filt=self.probe_filter)
+        devs, failed = probe.probe(devs, filt=self.probe_filter,
+                                   defer=self.pending)
 
         for d in devs:
+            if self.rebind_device(d):
+                continue
+
             try:
                 dd = self.init_device(d, nosave, enable)
                 self.devices.append(dd)
@@ -179,9 +360,13 @@ class Client:
 
         return failed
 
+    def rebind_device(self, d):
+        return False
+
     def save_devices(self):
         devs = list(filter(lambda d: not d.nosave, self.devices))
-        devstr = ','.join(sorted(map(str, devs + self.failed)))
+        devs += self.failed + [m for m, c in self.pending]
+        devstr = ','.join(sorted(map(str, devs)))
         if devstr != self.settings['devices']:
             self.settings['devices'] = devstr
 
@@ -195,6 +380,7 @@ class Client:
             dd = self.devices[self.devices.index(d)]
             self.del_device(dd)
 
+        self.clear_pending()
         self.failed = self.probe_devices(new);
         self.save_devices()
 
@@ -208,6 +394,7 @@ class Client:
         SETTINGS = {
             'devices':  [settings_path + '/Devices', '', 0, 0],
             'autoscan': [settings_path + '/AutoScan', self.auto_scan, 0, 1],
+            'scancursor': [settings_path + '/ScanCursor', '', 0, 0],
         }
 
         self.dbusconn = private_bus()
@@ -216,12 +403,35 @@ class Client:
         self.settings = SettingsDevice(self.dbusconn, SETTINGS,
                                        self.setting_changed, timeout=10)
 
-    def init_devices(self, force_scan):
-        self.update_devlist('', self.settings['devices'])
+    def clear_pending(self):
+        for m, c in self.pending:
+            c.put()
 
-        if not self.keep_failed:
-            self.failed = []
+        self.pending = []
 
+    # Probe devices deferred until their serial port is ready, then
+    # release the port reference held for them.
+    def probe_pending(self):
+        ready = [p for p in self.pending if p[1].is_ready()]
+        if not ready:
+            return
+
+        self.pending = [p for p in self.pending if p not in ready]
+        failed = self.probe_devices([m for m, c in ready])
+
+        if self.keep_failed:
+            self.failed += failed
+
+        for m, c in ready:
+            c.put()
+
+        self.save_devices()
+
+        if self.scan_deferred and not self.pending:
+            self.scan_deferred = False
+            self.init_scan()
+
+    def init_scan(self, force_scan=False):
         scan = force_scan
 
         if not self.devices or self.failed:
@@ -229,7 +439,20 @@ class Client:
                 scan = True
 
         if scan:
-            self.start_scan(force_scan)
+            self.start_scan(force_scan, resume=not force_scan)
+
+    def init_devices(self, force_scan):
+        self.update_devlist('', self.settings['devices'])
+
+        if not self.keep_failed:
+            self.failed = []
+
+        # decide on a scan once saved devices on ports still warming
+        # up have been probed
+        if self.pending and not force_scan:
+            self.scan_deferred = True
+        else:
+            self.init_scan(force_scan)
 
     def init(self, force_scan):
         self.watchdog.start()
@@ -245,14 +468,19 @@ class Client:
 
             self.scan_update()
 
-            if not self.scanner.running:
+            running = self.scanner.running
+            self.save_scan_cursor(not running)
+
+            if not running:
                 self.scan_complete()
                 self.scanner = None
                 if self.svc:
                     self.svc['/ScanProgress'] = None
 
-        for d in self.devices:
-            self.update_device(d)
+        self.update_devices()
+
+        if self.pending:
+            self.probe_pending()
 
         if self.failed:
             now = time.time()
@@ -291,6 +519,10 @@ class NetClient(Client):
         self.svc.add_path('/Scan', False, writeable=True,
                           onchangecallback=self.set_scan)
         self.svc.add_path('/ScanProgress', None, gettextcallback=percent)
+        self.svc.add_path('/Capture', 0, writeable=True,
+                          onchangecallback=self.dbus_set_capture)
+        self.svc.add_path('/Profile', 0, writeable=True,
+                          onchangecallback=self.dbus_set_profile)
 
     def init(self, *args):
         super().init(*args)
@@ -343,28 +575,58 @@ class NetClient(Client):
                 s.del_tree(dev.dev_path)
         super().del_device(dev)
 
+    def mdns_fast_start(self):
+        self.mdns_fast_query = time.time()
+        self.mdns_query_interval = MDNS_QUERY_INTERVAL / 10
+
+    def dev_offline(self, dev):
+        super().dev_offline(dev)
+
+        if dev.nosave:
+            self.mdns_fast_start()
+
     def dev_failed(self, dev):
         super().dev_failed(dev)
 
         if dev.nosave:
-            self.mdns_fast_query = time.time()
-            self.mdns_query_interval = MDNS_QUERY_INTERVAL / 10
+            self.mdns_fast_start()
+
+    # Move an offline device announced by mDNS at another address over
+    # to it, rather than adding it again.
+    def rebind_device(self, d):
+        for dev in self.devices:
+            if not (dev.nosave and dev.offline and dev.d.enabled):
+                continue
+
+            if dev.d.same_device(d):
+                dev.d.log.info('Moving to %s', d.spec)
+                dev.d.rebind(d)
+                dev.retry_time = 0
+                return True
+
+        return False
 
     def enable_device(self, dev, path, val):
         dev.set_enabled(bool(val))
         return True
 
 class SerialClient(Client):
-    def __init__(self, tty, rate, mode):
-        super().__init__(tty)
-        self.tty = tty
+    def __init__(self, ttys, rate, mode):
+        super().__init__('_'.join(ttys))
+        self.ttys = ttys
         self.rate = rate
         self.mode = mode
         self.auto_scan = True
         self.keep_failed = False
 
     def new_scanner(self, full):
-        return SerialScanner(self.tty, self.rate, self.mode, full=full)
+        scanners = [SerialScanner(t, self.rate, self.mode, full=full)
+                    for t in self.ttys]
+
+        if len(scanners) == 1:
+            return scanners[0]
+
+        return MultiScanner(scanners)
 
 def list_models():
     models = []
@@ -412,7 +674,13 @@ def main():
                         help='List supported device models')
     parser.add_argument('-P', '--probe', action='append')
     parser.add_argument('-r', '--rate', type=int, action='append')
-    parser.add_argument('-s', '--serial')
+    parser.add_argument('-s', '--serial', action='append')
+    parser.add_argument('--native-rtu', action='store_true',
+                        help='use built-in Modbus RTU serial transport')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='pipeline Modbus TCP register reads')
+    parser.add_argument('--scan-process', action='store_true',
+                        help='run bus scans in a separate process')
     parser.add_argument('-x', '--exit', action='store_true',
                         help='exit on error')
 
@@ -442,14 +710,24 @@ def main():
     mainloop = GLib.MainLoop()
 
     if args.serial:
-        tty = os.path.basename(args.serial)
-        client = SerialClient(tty, args.rate, args.mode)
+        ttys = [os.path.basename(s) for s in args.serial]
+        client = SerialClient(ttys, args.rate, args.mode)
     else:
         client = NetClient()
 
+    RtuClient.enabled = args.native_rtu
+    TcpClient.pipeline = args.pipeline
+
     client.err_exit = args.exit
+    client.scan_process = args.scan_process
     client.init(args.force_scan)
 
+    # run on the main loop, not at an arbitrary point in an update
+    signal.signal(signal.SIGRTMIN,
+                  lambda s, f: GLib.idle_add(client.toggle_capture))
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR2,
+                         signal_toggle, client.toggle_profile)
+
     GLib.timeout_add(UPDATE_INTERVAL, client.update_timer)
     mainloop.run()
 
@@ -168,12 +168,12 @@ class DEIF_Generator(device.CustomName, device.ErrorId, device.Genset):
 
     def _start_genset(self, _, value):
         # Auto start/stop
-        self.write_modbus(6, [1 | bool(value) << 11])
-        return True
+        return self.defer_write(self.write_modbus, 6,
+                                [1 | bool(value) << 11])
 
     def _set_remote_start_mode(self, _, value):
         if value == 1:
-            self.write_modbus(6, [(1 | 1 << 13)]) # AUTO mode
+            self.defer_write(self.write_modbus, 6, [(1 | 1 << 13)]) # AUTO mode
         return False
 
 
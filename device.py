@@ -1,3 +1,5 @@
+import collections
+import copy
 import dbus
 from functools import partial
 import logging
@@ -9,13 +11,18 @@ from settingsdevice import SettingsDevice
 from vedbus import VeDbusService, VeDbusItemImport, ServiceContext
 
 import __main__
+import client
 from register import Reg
 from utils import *
+import vecdecode
 
 class RegList(list):
     def __init__(self, access=None, regs=[]):
         super().__init__(regs)
         self.access = access
+        self.write = None
+        self.latency = None
+        self.decoder = None
 
 def modbus_overhead(method):
     overhead = 5 + 2                # request + response
@@ -61,14 +68,33 @@ class BaseDevice:
     refresh_time = None
     age_limit = 4
     age_limit_fast = 1
+    age_limit_max = 30
+    adaptive_age = False
+    age_bounds = {}
     fast_regs = ('/Ac/L1/Power', '/Ac/L2/Power', '/Ac/L3/Power', '/Ac/Power')
     allowed_roles = None
     default_access = 'holding'
     reg_hole_max = None
     reg_barrier = None
+    pipeline_depth = 4
+    transport = None
+    coalesce_writes = True
+    combined_rw = False
+    inplace_role_switch = True
+    priority = None
+    role_priority = {
+        'grid':         0,
+        'pvinverter':   1,
+        'acload':       1,
+        'genset':       2,
+        'tank':         3,
+    }
+    default_priority = 2
 
     def __init__(self):
         self.role = None
+        self.connected = True
+        self.deadline = None
         self.info = {}
         self.dbus = None
         self.settings = None
@@ -77,6 +103,9 @@ class BaseDevice:
         self.info_regs = []
         self.data_regs = []
         self.alias_regs = {}
+        self.write_queue = []
+        self.age_adapt = {}
+        self.reg_dbus = {}
 
     def destroy(self):
         if self.dbus:
@@ -121,49 +150,232 @@ class BaseDevice:
         reg.decode(rr.registers)
         return reg.value
 
+    def readwrite_modbus(self, start, count, waddr, val):
+        return self.modbus.readwrite_registers(read_address=start,
+                                               read_count=count,
+                                               write_address=waddr,
+                                               write_registers=val,
+                                               unit=self.unit)
+
     def write_modbus(self, base, val):
         if len(val) == 1:
-            self.modbus.write_register(base, val[0], unit=self.unit)
+            rr = self.modbus.write_register(base, val[0], unit=self.unit)
         else:
-            self.modbus.write_registers(base, val, unit=self.unit)
+            rr = self.modbus.write_registers(base, val, unit=self.unit)
+
+        if rr.isError():
+            self.log.error('Error writing register %#04x: %s', base, rr)
+
+        return rr
 
     def write_register(self, reg, val):
         reg.value = val
         self.write_modbus(reg.base, reg.encode())
 
+    # Queue a register write, appending it to the last queued write if
+    # it directly follows that in address.
+    def queue_write(self, reg, val):
+        reg.value = val
+        val = list(reg.encode())
+        queue = self.write_queue
+
+        if queue and not callable(queue[-1]):
+            start, prev = queue[-1]
+            if start + len(prev) == reg.base and len(prev) + len(val) <= 121:
+                prev += val
+                return
+
+        queue.append((reg.base, val))
+
+    # Queue a write from a D-Bus handler to run at the start of the next
+    # update.  Writes are refused while the device is offline.
+    def defer_write(self, func, *args, **kwargs):
+        if not self.connected:
+            return False
+
+        self.write_queue.append(partial(func, *args, **kwargs))
+        return True
+
+    def write_pending(self):
+        return bool(self.write_queue)
+
+    # Perform queued writes in the order they were made.  A lone
+    # register write may instead go out with the next read of its block,
+    # as folded writes are sent in block read order.
+    def flush_writes(self):
+        queue = self.write_queue
+        self.write_queue = []
+
+        if self.combined_rw and len(queue) == 1 and \
+           not callable(queue[0]) and self.fold_write(*queue[0]):
+            return
+
+        for w in queue:
+            try:
+                if callable(w):
+                    w()
+                else:
+                    self.write_modbus(*w)
+            except:
+                traceback.print_exc()
+
+    # Attach a write to the polled holding register block containing
+    # it, to be sent along with the next read of the block using FC23.
+    def fold_write(self, start, val):
+        for regs in self.data_regs:
+            if regs.write or \
+               (regs.access or self.default_access) != 'holding':
+                continue
+
+            rstart, rcount = self.data_regs_range(regs)
+
+            if rstart <= start and start + len(val) <= rstart + rcount:
+                regs.write = (start, val)
+                return True
+
+        return False
+
     def read_info_regs(self, d):
         for reg in self.info_regs:
             self.read_register(reg)
             d[reg.name] = reg
 
+    def data_regs_due(self, regs, now):
+        return not all(now - r.time < r.max_age for r in regs)
+
+    def data_regs_range(self, regs):
+        start = regs[0].base
+        count = regs[-1].base + regs[-1].count - start
+        return start, count
+
     def read_data_regs(self, regs, d):
         now = time.time()
 
-        if all(now - r.time < r.max_age for r in regs):
+        if not (regs.write or self.data_regs_due(regs, now)):
             return
 
-        start = regs[0].base
-        count = regs[-1].base + regs[-1].count - start
+        start, count = self.data_regs_range(regs)
+        timeout = self.modbus.timeout
+        self.modbus.timeout = self.block_timeout([regs])
 
-        rr = self.read_modbus(start, count, regs.access)
+        try:
+            if regs.write:
+                rr = self.readwrite_modbus(start, count, *regs.write)
+                self.write_done(regs, rr)
+            else:
+                rr = self.read_modbus(start, count, regs.access)
+        finally:
+            self.modbus.timeout = timeout
 
         latency = time.time() - now
 
+        self.decode_data_regs(regs, rr, now, d)
+        self.block_latency(regs, latency)
+
+        return latency
+
+    def read_data_regs_pipelined(self, d):
+        now = time.time()
+        deadline = self.get_deadline()
+        due = [r for r in self.data_regs
+               if r.write or self.data_regs_due(r, now)]
+        latency = []
+
+        if deadline:
+            due.sort(key=self.block_time)
+
+        for i in range(0, len(due), self.pipeline_depth):
+            if latency and deadline and time.time() > deadline:
+                break
+
+            batch = due[i:i + self.pipeline_depth]
+            reqs = []
+
+            for regs in batch:
+                start, count = self.data_regs_range(regs)
+                access = regs.access or self.default_access
+
+                if regs.write:
+                    reqs.append(self.modbus.readwrite_request(
+                        start, count, *regs.write, unit=self.unit))
+                else:
+                    reqs.append(self.modbus.read_request(start, count, access,
+                                                         unit=self.unit))
+
+            timeout = self.modbus.timeout
+            self.modbus.timeout = self.block_timeout(batch)
+
+            try:
+                t0 = time.time()
+                rr = self.modbus.execute_many(reqs)
+                t = time.time() - t0
+            finally:
+                self.modbus.timeout = timeout
+
+            latency.append(t)
+
+            for regs, r in zip(batch, rr):
+                if regs.write:
+                    self.write_done(regs, r)
+                self.decode_data_regs(regs, r, now, d)
+                self.block_latency(regs, t)
+
+        return latency
+
+    def block_timeout(self, blocks):
+        if not all(r.latency for r in blocks):
+            return self.modbus.timeout
+
+        t = max(r.latency.timeout() for r in blocks)
+        return max(self.min_timeout, t)
+
+    def block_latency(self, regs, t):
+        if regs.latency:
+            regs.latency.update(t)
+        else:
+            regs.latency = BlockLatency(t)
+
+    def write_done(self, regs, rr):
+        write = regs.write
+        regs.write = None
+
+        # the write may not have happened, send it on its own
+        if rr.isError():
+            try:
+                self.write_modbus(*write)
+            except:
+                traceback.print_exc()
+            return
+
+        # force decoding of the whole block with the new values
+        for r in regs:
+            r.time = 0
+
+    def decode_data_regs(self, regs, rr, now, d):
+        start, count = self.data_regs_range(regs)
+
         if rr.isError():
             raise Exception('Error reading registers %#04x-%#04x: %s' %
                             (start, start + count - 1, rr))
 
-        for reg in regs:
+        values = regs.decoder.decode(rr.registers) if regs.decoder else None
+
+        # the whole block was transferred, so update every register
+        for i, reg in enumerate(regs):
             base = reg.base - start
             end = base + reg.count
 
-            if now - reg.time > reg.max_age:
-                if reg.decode(rr.registers[base:end]) or not reg.time:
-                    if reg.name:
-                        d[reg.name] = reg.copy_if_valid()
-                reg.time = now
-
-        return latency
+            if values:
+                changed = reg.update(values[i])
+            else:
+                changed = reg.decode(rr.registers[base:end])
+            if changed or not reg.time:
+                if reg.name:
+                    dd = self.reg_dbus.get(id(reg), d)
+                    dd[reg.name] = reg.copy_if_valid()
+            if self.age_adapt:
+                self.adapt_max_age(reg, changed, now)
+            reg.time = now
 
     def read_info(self):
         if not self.info:
@@ -199,7 +411,7 @@ class BaseDevice:
 
             if role != self.role:
                 self.role = role
-                self.sched_reinit()
+                self.sched_role_switch()
                 return True
 
             if self.dbus:
@@ -253,10 +465,16 @@ class BaseDevice:
         self.settings['instance'] = '%s:%s' % (val, inst)
         return True
 
+    # Writes are only validated here and performed at the start of the
+    # next update, keeping Modbus I/O out of the D-Bus handler.
     def dbus_write_register(self, reg, path, val):
+        if not self.connected:
+            return False
+
         try:
             val = get_super(Reg, reg)(val)
 
+            # the callback gives the verdict and defers its own writes
             if callable(reg.write):
                 return reg.write(val)
 
@@ -268,7 +486,14 @@ class BaseDevice:
                 if not reg.write[0] <= val <= reg.write[1]:
                     return False
 
-            self.write_register(reg, val)
+            if self.coalesce_writes:
+                self.queue_write(reg, val)
+            else:
+                self.defer_write(self.write_register, reg, val)
+
+            # read back the written value on the next update
+            reg.time = 0
+
             return True
         except:
             traceback.print_exc()
@@ -291,8 +516,19 @@ class BaseDevice:
         for alias in self.alias_regs.get(name, ()):
             self.dbus_add_reg_alias(r, alias)
 
+    def reg_has_alias(self, r, name):
+        oc = r.onchange
+
+        while isinstance(oc, partial) and oc.func == self.dbus_update_alias:
+            if oc.args[0] == name:
+                return True
+            oc = oc.args[1]
+
+        return False
+
     def dbus_add_reg_alias(self, r, name):
-        r.onchange = partial(self.dbus_update_alias, name, r.onchange)
+        if not self.reg_has_alias(r, name):
+            r.onchange = partial(self.dbus_update_alias, name, r.onchange)
         self.dbus_add_register(r, name)
 
     def dbus_update_alias(self, name, onchange, reg):
@@ -306,6 +542,32 @@ class BaseDevice:
         else:
             reg.max_age = self.age_limit
 
+    # Poll registers which have not changed for a while less often,
+    # at half the time since the last change, within per-path bounds.
+    # Fast, writable and onchange registers keep their fixed rate.
+    def init_adaptive_age(self, reg):
+        if reg.name in self.fast_regs or reg.write or reg.onchange:
+            return
+
+        lo, hi = self.age_bounds.get(reg.name, (None, None))
+        lo = lo or reg.max_age
+        hi = max(hi or self.age_limit_max, lo)
+
+        self.age_adapt[id(reg)] = [lo, hi, 0]
+
+    def adapt_max_age(self, reg, changed, now):
+        a = self.age_adapt.get(id(reg))
+        if not a:
+            return
+
+        lo, hi, last = a
+
+        if changed or not last:
+            a[2] = now
+            reg.max_age = lo
+        else:
+            reg.max_age = min(max(0.5 * (now - last), lo), hi)
+
     def init_dbus(self):
         ident = self.get_ident()
 
@@ -335,20 +597,48 @@ class BaseDevice:
         for p in self.info:
             self.dbus_add_register(self.info[p])
 
+    def init_data_reg(self, reg):
+        if reg.max_age is None:
+            self.set_max_age(reg)
+            if self.adaptive_age:
+                self.init_adaptive_age(reg)
+        if reg.name:
+            self.dbus_add_register(reg)
+
     def init_data_regs(self):
         self.data_regs = self.pack_regs(self.data_regs)
+        self.age_adapt = {}
+        self.reg_dbus = {}
 
         for r in self.data_regs:
+            r.decoder = vecdecode.make_decoder(r)
+
             for rr in r:
-                if rr.max_age is None:
-                    self.set_max_age(rr)
-                if rr.name:
-                    self.dbus_add_register(rr)
+                self.init_data_reg(rr)
+
+    def get_deadline(self):
+        return self.deadline
+
+    def block_time(self, regs):
+        return min(r.time for r in regs)
 
+    # With a deadline, read blocks most stale first and stop once it
+    # has passed, leaving the rest for the next update.
     def update_data_regs(self):
+        if self.pipeline_depth > 1 and self.modbus.pipeline:
+            return self.read_data_regs_pipelined(self.dbus)
+
+        deadline = self.get_deadline()
+        regs = self.data_regs
         latency = []
 
-        for r in self.data_regs:
+        if deadline:
+            regs = sorted(regs, key=self.block_time)
+
+        for r in regs:
+            if latency and deadline and time.time() > deadline:
+                break
+
             t = self.read_data_regs(r, self.dbus)
             if t:
                 latency.append(t)
@@ -358,6 +648,17 @@ class BaseDevice:
     def post_update(self):
         self.dbus.flush()
 
+    def set_connected(self, connected):
+        self.connected = connected
+
+        # drop writes accepted before the device went offline
+        if not connected:
+            self.write_queue = []
+
+        if self.dbus:
+            self.dbus['/Connected'] = int(connected)
+            self.dbus.flush()
+
     def device_init(self):
         pass
 
@@ -370,6 +671,11 @@ class BaseDevice:
     def get_ident(self):
         return '%s_%s' % (self.vendor_id, self.get_unique())
 
+    def get_priority(self):
+        if self.priority is not None:
+            return self.priority
+        return self.role_priority.get(self.role, self.default_priority)
+
     def get_name(self):
         return str(self.info.get('/CustomName', '')) or self.productname
 
@@ -377,12 +683,19 @@ class ModbusDevice(BaseDevice):
     def __init__(self, spec, modbus, model):
         super().__init__()
         self.spec = spec
-        self.modbus = modbus.get()
+
+        # use a client of its own when overriding transport options
+        if self.transport and spec.method in ('tcp', 'udp'):
+            self.modbus = client.make_client(spec, self.transport)
+        else:
+            self.modbus = modbus.get()
+
         self.unit = spec.unit
         self.model = model
         self.subdevices = []
         self.latency = modbus.timeout
         self.need_reinit = False
+        self.need_role_switch = False
         self.log = logging.getLogger(str(self))
         self.log.addFilter(self)
 
@@ -398,6 +711,37 @@ class ModbusDevice(BaseDevice):
         self.info.clear()
         self.modbus.put()
 
+    # Check whether a device found elsewhere is this one, by reading the
+    # info registers of this device there.
+    def same_device(self, dev):
+        if type(dev) is not type(self) or dev.model != self.model:
+            return False
+
+        try:
+            for reg in self.info_regs:
+                r = copy.copy(reg)
+                dev.read_register(r)
+                if r.value != reg.value:
+                    return False
+        except:
+            return False
+
+        return True
+
+    # Move to the address the same device was found at, keeping the
+    # D-Bus service and settings.
+    def rebind(self, dev):
+        self.modbus.put()
+        self.spec = dev.spec
+        self.modbus = dev.modbus.get()
+        self.modbus.timeout = self.timeout
+        dev.destroy()
+
+        for d in [self] + self.subdevices:
+            d.modbus = self.modbus
+            if d.dbus:
+                d.dbus['/Mgmt/Connection'] = self.connection()
+
     def __eq__(self, other):
         return str(self) == str(other)
 
@@ -460,6 +804,32 @@ class ModbusDevice(BaseDevice):
     def sched_reinit(self):
         self.need_reinit = True
 
+    def sched_role_switch(self):
+        if self.inplace_role_switch and self.dbus:
+            self.need_role_switch = True
+        else:
+            self.sched_reinit()
+
+    # Move the device to a new D-Bus service for its new role, keeping
+    # settings, packed registers and their last values.
+    def switch_role(self):
+        self.need_role_switch = False
+        self.role, self.devinst = self.get_role_instance()
+        self.log.info('Switching role to %s', self.role)
+
+        self._dbus.__del__()
+        self.init_dbus()
+
+        for r in self.data_regs:
+            for rr in r:
+                if rr.name and id(rr) not in self.reg_dbus:
+                    self.dbus_add_register(rr)
+
+        self.device_init_late()
+
+        self.dbus.flush()
+        self._dbus.register()
+
     def init(self, dbus, enable=True):
         self.enabled = enable
         self.modbus.timeout = self.timeout
@@ -478,6 +848,7 @@ class ModbusDevice(BaseDevice):
         self.latfilt = LatencyFilter(self.latency)
         self.device_init_late()
         self.need_reinit = False
+        self.need_role_switch = False
 
         self.dbus.flush()
         self._dbus.register()
@@ -485,9 +856,46 @@ class ModbusDevice(BaseDevice):
         for s in self.subdevices:
             s.init()
 
-    def update(self):
+        if self.subdevices:
+            self.merge_subdevice_regs()
+
+    # Pack subdevice registers into our own blocks so registers shared
+    # by a block are read once, each value going to its owner's service.
+    def merge_subdevice_regs(self):
+        regs = [self.data_regs]
+
+        for s in self.subdevices:
+            for r in flatten(s.data_regs):
+                self.reg_dbus[id(r)] = s.dbus
+
+            regs.append(s.data_regs)
+            self.age_adapt.update(s.age_adapt)
+            s.data_regs = []
+
+        self.data_regs = self.pack_regs(regs)
+
+        for r in self.data_regs:
+            r.decoder = vecdecode.make_decoder(r)
+
+    def flush_writes(self):
+        self.modbus.timeout = self.timeout
+        super().flush_writes()
+
+        for s in self.subdevices:
+            s.flush_writes()
+
+    def write_pending(self):
+        return super().write_pending() or \
+            any(s.write_pending() for s in self.subdevices)
+
+    def update(self, deadline=None):
+        self.deadline = deadline
+        self.flush_writes()
+
         if self.need_reinit:
             self.reinit()
+        elif self.need_role_switch:
+            self.switch_role()
 
         if not self.enabled:
             return
@@ -507,6 +915,12 @@ class ModbusDevice(BaseDevice):
             self.latency = self.latfilt.filter(latency)
             self.timeout = max(self.min_timeout, self.latency * 4)
 
+    def set_connected(self, connected):
+        super().set_connected(connected)
+
+        for s in self.subdevices:
+            s.set_connected(connected)
+
     def set_enabled(self, enabled):
         if enabled == self.enabled:
             return
@@ -560,6 +974,20 @@ class SubDevice(BaseDevice):
     def sched_reinit(self):
         self.parent.sched_reinit()
 
+    def sched_role_switch(self):
+        self.parent.sched_reinit()
+
+    # Registers are read as part of the parent's blocks, see
+    # ModbusDevice.merge_subdevice_regs()
+    def init_data_regs(self):
+        self.age_adapt = {}
+
+        for r in flatten(self.data_regs):
+            self.init_data_reg(r)
+
+    def get_deadline(self):
+        return self.parent.get_deadline()
+
     def device_update(self):
         self.update_data_regs()
 
@@ -584,6 +1012,26 @@ class LatencyFilter:
 
         return self.val
 
+# Response time estimate for one register block: smoothed mean and
+# deviation as for TCP retransmit timers, bounded below by a high
+# percentile of recent samples.
+class BlockLatency:
+    def __init__(self, val):
+        self.avg = val
+        self.dev = val / 2
+        self.samples = collections.deque([val], maxlen=16)
+
+    def update(self, val):
+        err = val - self.avg
+        self.avg += 0.125 * err
+        self.dev += 0.25 * (abs(err) - self.dev)
+        self.samples.append(val)
+
+    def timeout(self):
+        s = sorted(self.samples)
+        p90 = s[int(0.9 * (len(s) - 1))]
+        return max(self.avg + 4 * self.dev, 2 * p90)
+
 class CustomName:
     def device_init_late(self):
         super().device_init_late()
@@ -717,8 +1165,13 @@ class Tank:
         rvlo = min(rvempty, rvfull)
         rvhi = max(rvempty, rvfull)
 
-        rval = float(self.dbus['/RawValue'])
-        rval = min(max(rval, rvlo), rvhi)
+        rval = self.dbus['/RawValue']
+
+        # the block holding the raw value may not have been read yet
+        if rval is None:
+            return
+
+        rval = min(max(float(rval), rvlo), rvhi)
 
         level = (rval - rvempty) / (rvfull - rvempty)
         remain = level * self.settings['capacity']
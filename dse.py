@@ -284,14 +284,15 @@ class DSE_Generator(device.CustomName, device.ErrorId, device.Genset):
 
     def _start_genset(self, path, value):
         if value:
-            self._write_scf_key(self.SCF_TELEMETRY_START)
+            key = self.SCF_TELEMETRY_START
         else:
-            self._write_scf_key(self.SCF_TELEMETRY_STOP)
-        return True
+            key = self.SCF_TELEMETRY_STOP
+        return self.defer_write(self._write_scf_key, key)
 
     def _set_remote_start_mode(self, _, value):
         if value == 1:
-            self._write_scf_key(self.SCF_SELECT_AUTO_MODE)
+            return self.defer_write(self._write_scf_key,
+                                    self.SCF_SELECT_AUTO_MODE)
         return True
 
 class DSE4xxx_Generator(DSE_Generator):
@@ -50,6 +50,7 @@ class EV_Charger(device.ModbusDevice):
     default_instance = 40
     productname = 'EV Charging Station'
     min_timeout = 0.5
+    combined_rw = True
 
     def device_init(self):
         self.info_regs = [
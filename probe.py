@@ -9,7 +9,8 @@ log = logging.getLogger()
 
 device_types = []
 
-def probe(mlist, pr_cb=None, pr_interval=10, timeout=None, filt=None):
+def probe(mlist, pr_cb=None, pr_interval=10, timeout=None, filt=None,
+          defer=None):
     num_probed = 0
     found = []
     failed = []
@@ -24,6 +25,11 @@ def probe(mlist, pr_cb=None, pr_interval=10, timeout=None, filt=None):
         if not modbus:
             continue
 
+        # the caller holds the client, keeping the port open until ready
+        if defer is not None and not modbus.is_ready():
+            defer.append((m, modbus))
+            continue
+
         d = None
 
         for t in device_types:
@@ -71,6 +77,22 @@ def probe(mlist, pr_cb=None, pr_interval=10, timeout=None, filt=None):
 
     return found, failed
 
+# Create a device found by a probe elsewhere, e.g. in a scan process,
+# without probing it again.
+def create_device(spec, handler, model, latency):
+    modbus = client.make_client(spec)
+    if not modbus:
+        raise Exception('Unable to open %s' % spec)
+
+    try:
+        d = handler(spec, modbus, model)
+    finally:
+        modbus.put()
+
+    d.latency = latency
+    d.timeout = max(d.min_timeout, latency * 4)
+    return d
+
 def add_handler(devtype):
     if devtype not in device_types:
         device_types.append(devtype)
@@ -90,6 +112,10 @@ def get_units(method):
 def get_rates(method):
     return get_attrs('rates', method)
 
+def get_max_count(method):
+    return max((t.reg.count for t in device_types if method in t.methods),
+               default=1)
+
 class ModelRegister:
     def __init__(self, reg, models, **args):
         self.reg = reg
@@ -0,0 +1,71 @@
+import contextlib
+import cProfile
+import io
+import logging
+import pstats
+import time
+
+log = logging.getLogger()
+
+class Profiler:
+    def __init__(self):
+        self.prof = None
+        self.start_time = None
+        self.devices = {}
+
+    @property
+    def running(self):
+        return self.prof is not None
+
+    def start(self):
+        if self.prof:
+            return
+
+        self.devices = {}
+        self.start_time = time.time()
+        self.prof = cProfile.Profile()
+        self.prof.enable()
+
+    def stop(self, path):
+        if not self.prof:
+            return
+
+        self.prof.disable()
+        prof = self.prof
+        self.prof = None
+
+        elapsed = time.time() - self.start_time
+
+        out = io.StringIO()
+        out.write('Profiled %.1f seconds\n\n' % elapsed)
+        out.write('%-40s %8s %10s %10s %6s\n' %
+                  ('Device', 'Polls', 'Total [s]', 'Mean [ms]', 'Load'))
+
+        devs = sorted(self.devices.items(), key=lambda d: -d[1][1])
+        for name, (n, t) in devs:
+            out.write('%-40s %8d %10.3f %10.2f %5.1f%%\n' %
+                      (name, n, t, 1000 * t / n, 100 * t / elapsed))
+
+        out.write('\n')
+
+        stats = pstats.Stats(prof, stream=out)
+        stats.sort_stats('cumulative').print_stats(50)
+
+        with open(path + '.txt', 'w') as f:
+            f.write(out.getvalue())
+
+        prof.dump_stats(path + '.prof')
+
+    @contextlib.contextmanager
+    def device(self, name):
+        if not self.prof:
+            yield
+            return
+
+        t0 = time.time()
+
+        try:
+            yield
+        finally:
+            n, t = self.devices.get(name, (0, 0))
+            self.devices[name] = (n + 1, t + time.time() - t0)
@@ -1,6 +1,5 @@
 from copy import copy
 import struct
-from utils import get_enum
 from collections.abc import Iterable
 
 class Reg:
@@ -138,11 +137,13 @@ class Reg_e16(Reg, int):
     def __init__(self, base, name, enum, **kwargs):
         super().__init__(base, 1, name, **kwargs)
         self.enum = enum
+        self.enum_map = {m.value: m for m in enum}
         if self.write == True:
             self.write = [m.value for m in enum]
 
     def decode(self, values):
-        return self.update(get_enum(self.enum, values[0]))
+        v = values[0]
+        return self.update(self.enum_map.get(v, v))
 
     def encode(self):
         return [self.value]
@@ -177,13 +178,10 @@ class Reg_map:
     def __init__(self, base, name, tab, *args, **kwargs):
         super().__init__(base, name, *args, **kwargs)
         self.tab = tab
+        self.lookup = tab.get
 
     def decode(self, values):
-        if values[0] in self.tab:
-            v = self.tab[values[0]]
-        else:
-            v = None
-        return self.update(v)
+        return self.update(self.lookup(values[0]))
 
 class Reg_mapu16(Reg_map, Reg_u16):
     pass
@@ -194,24 +192,14 @@ class Reg_packed(Reg):
         self.bits = bits
         self.mask = (1 << bits) - 1
         self.init_pos = bits * (items - 1)
+        self.shifts = range(self.init_pos, -1, -bits)
 
     def unpack(self, values):
-        values = iter(values)
-        pos = -1
-
-        while True:
-            if pos < 0:
-                try:
-                    val = next(values)
-                    pos = self.init_pos
-                except StopIteration:
-                    return
-
-            yield (val >> pos) & self.mask
-            pos -= self.bits
+        mask = self.mask
+        return [(v >> s) & mask for v in values for s in self.shifts]
 
     def decode(self, values):
-        return self.update(list(self.unpack(values)))
+        return self.update(self.unpack(values))
 
 class Reg_bit(Reg, int):
     def __init__(self, base, *args, bit, set=1, unset=0, **kwargs):
@@ -219,7 +207,9 @@ class Reg_bit(Reg, int):
         self.bit = bit
         self.set = set
         self.unset = unset
+        self.word = bit // 16
+        self.bitmask = 1 << bit % 16
 
     def decode(self, values):
-        v = values[self.bit // 16] & (1 << self.bit % 16)
+        v = values[self.word] & self.bitmask
         return self.update(self.set if v else self.unset)
@@ -1,11 +1,16 @@
 from itertools import chain
+import ipaddress
 import queue
+import serial
 import threading
 import logging
 import time
 import traceback
 
+from pymodbus.utilities import computeCRC
+
 from utils import *
+import client
 import device
 import devspec
 import probe
@@ -15,6 +20,43 @@ log = logging.getLogger()
 MODBUS_UNIT_MIN = 1
 MODBUS_UNIT_MAX = 247
 
+RESPONSE_CHARS = 40            # device turnaround in character times
+RESPONSE_MIN = 0.03
+SCAN_YIELD = 0.01
+DETECT_TIME = 0.25
+
+def rtu_frame_sizes(buf, i):
+    fc = buf[i + 1]
+
+    if fc & 0x80:
+        return [5]
+
+    if fc in (1, 2, 3, 4):
+        return [8, 5 + buf[i + 2]]
+
+    if fc in (5, 6):
+        return [8]
+
+    if fc in (15, 16):
+        return [8, 9 + buf[i + 6]] if len(buf) > i + 6 else [8]
+
+    if fc == 23:
+        return [5 + buf[i + 2], 13 + buf[i + 10]] if len(buf) > i + 10 \
+            else [5 + buf[i + 2]]
+
+    return []
+
+def find_rtu_frame(buf):
+    for i in range(len(buf) - 4):
+        if not MODBUS_UNIT_MIN <= buf[i] <= MODBUS_UNIT_MAX:
+            continue
+
+        for n in rtu_frame_sizes(buf, i):
+            if i + n <= len(buf) and computeCRC(buf[i:i + n]) == 0:
+                return buf[i:i + n]
+
+    return None
+
 class ScanAborted(Exception):
     pass
 
@@ -26,6 +68,12 @@ class Scanner:
         self.done = None
         self.lock = threading.Lock()
         self.num_found = 0
+        self.use_process = False
+        self.proc = None
+        self.conn = None
+        self.cursor = None
+        self.resume = None
+        self.parent = None
 
     def progress(self, n, dev):
         if not self.running:
@@ -35,9 +83,40 @@ class Scanner:
 
         if dev:
             self.num_found += 1
+
+        if self.parent:
+            self.parent.progress(n, dev)
+        elif self.conn:
+            self.send(n, dev)
+        elif dev:
             with self.lock:
                 self.devices.append(dev)
 
+    def send(self, n, dev):
+        found = None
+        if dev:
+            found = (dev.spec, type(dev), dev.model, dev.latency)
+
+        try:
+            with self.lock:
+                self.conn.send((n, found, self.cursor))
+        except OSError:
+            self.stop()
+            raise ScanAborted()
+        finally:
+            if dev:
+                dev.destroy()
+
+    # Only the configuration is passed to a scan process
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(devices=[], lock=None, proc=None, conn=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
     def run(self):
         try:
             t0 = time.time()
@@ -51,16 +130,62 @@ class Scanner:
 
         if self.running:
             log.info('Scan completed in %d seconds', t1 - t0)
+            self.cursor = None
         else:
             log.info('Scan aborted')
 
         self.running = False
 
+    def run_process(self, conn, locks, ports):
+        client.port_locks.update(locks)
+        client.parent_ports.update(ports)
+
+        self.conn = conn
+        self.run()
+
+        try:
+            conn.send((0, None, self.cursor))
+        except OSError:
+            pass
+
+        conn.close()
+
+    def wait_ready(self):
+        pass
+
+    # Run the scan in a fresh process rather than a fork of this one,
+    # which has mDNS, D-Bus and GLib threads.  It gets the shared serial
+    # port locks and the rates of the ports open here.  Called in a
+    # thread, as it may have to wait for ports to be ready.
+    def start_process(self):
+        self.wait_ready()
+        if not self.running:
+            return
+
+        ctx = client.mp_context
+        rd, wr = ctx.Pipe(duplex=False)
+
+        ports = {t: c.baudrate for t, c in client.serial_ports.items()}
+        args = (wr, client.port_locks, ports)
+
+        proc = ctx.Process(target=self.run_process, args=args)
+        proc.daemon = True
+        proc.start()
+
+        wr.close()
+        self.conn = rd
+        self.proc = proc
+
     def start(self):
         self.done = 0
         self.running = True
 
-        t = threading.Thread(target=self.run)
+        if self.use_process:
+            target = self.start_process
+        else:
+            target = self.run
+
+        t = threading.Thread(target=target)
         t.daemon = True
         t.start()
 
@@ -69,7 +194,33 @@ class Scanner:
     def stop(self):
         self.running = False
 
+    def recv_devices(self):
+        devs = []
+
+        try:
+            while self.running and self.conn.poll():
+                n, dev, self.cursor = self.conn.recv()
+                self.done += n
+                if not dev:
+                    continue
+
+                try:
+                    devs.append(probe.create_device(*dev))
+                except:
+                    log.info('Error creating device %s found by scan', dev[0])
+        except EOFError:
+            self.proc.join()
+            self.running = False
+
+        if not self.running:
+            self.conn.close()
+
+        return devs
+
     def get_devices(self):
+        if self.proc:
+            return self.recv_devices()
+
         with self.lock:
             d = self.devices
             self.devices = []
@@ -83,6 +234,11 @@ class NetScanner(Scanner):
         self.blacklist = blacklist
         self.timeout = timeout
 
+    def host_done(self, host):
+        with self.lock:
+            self.pending.remove(host)
+            self.cursor = str(min(self.pending, default=self.next_host))
+
     def do_probe(self):
         while True:
             host = self.hosts.get()
@@ -96,12 +252,36 @@ class NetScanner(Scanner):
             except:
                 pass
 
+            self.host_done(host)
             self.hosts.task_done()
 
+    def get_hosts(self):
+        for h in chain(*map(lambda n: n.hosts(), self.nets)):
+            if h not in self.addrs:
+                yield h
+
+    def get_resume(self):
+        try:
+            addr = ipaddress.IPv4Address(self.resume)
+        except:
+            return None
+
+        if not any(addr in n for n in self.nets):
+            return None
+
+        return addr
+
     def scan(self):
         self.hosts = queue.Queue(maxsize=8)
+        self.pending = set()
         tasks = []
 
+        resume = self.get_resume()
+        if resume:
+            log.info('Resuming scan at %s', resume)
+            skipped = sum(1 for h in self.get_hosts() if h < resume)
+            self.progress(len(self.protos) * skipped, None)
+
         log.info('Scanning %s', ', '.join(map(str, self.nets)))
 
         for i in range(8):
@@ -109,13 +289,17 @@ class NetScanner(Scanner):
             t.start()
             tasks.append(t)
 
-        for h in chain(*map(lambda n: n.hosts(), self.nets)):
+        for h in self.get_hosts():
             if not self.running:
                 break
 
-            if h in self.addrs:
+            if resume and h < resume:
                 continue
 
+            with self.lock:
+                self.next_host = h
+                self.pending.add(h)
+
             self.hosts.put(h)
 
         if self.running:
@@ -143,27 +327,97 @@ class NetScanner(Scanner):
         return super().start()
 
 class SerialScanner(Scanner):
-    def __init__(self, tty, rates, mode, timeout=0.1, full=False):
+    def __init__(self, tty, rates, mode, timeout=None, full=False):
         super().__init__()
         self.tty = tty
         self.rates = rates
         self.mode = mode
         self.timeout = timeout
         self.full = full
+        self.rate = None
+        self.unit_queue = None
 
     def progress(self, n, dev):
+        if self.unit_queue is not None:
+            del self.unit_queue[:n]
+            u = self.unit_queue[0] if self.unit_queue else MODBUS_UNIT_MAX + 1
+            self.cursor = '%s:%d:%d' % (self.tty, self.rate, u)
+
         super().progress(n, dev)
         if self.num_found:
-            time.sleep(1)
+            # give polling of found devices a chance to take the port
+            time.sleep(SCAN_YIELD)
+
+    def get_timeout(self, rate):
+        if self.timeout:
+            return self.timeout
+
+        # read request is 8 bytes, response 5 + 2 per register
+        nresp = 5 + 2 * probe.get_max_count(self.mode)
+        turnaround = max(RESPONSE_CHARS * client.char_time(rate), RESPONSE_MIN)
+        return client.frame_time(self.mode, rate, 8, nresp) + turnaround
+
+    def scan_units(self, units, rate, full=False):
+        units = sorted(units)
+        self.rate = rate
+        self.unit_queue = list(units) if full else None
 
-    def scan_units(self, units, rate):
         mlist = [devspec.create(self.mode, self.tty, rate, u) for u in units]
-        d = probe.probe(mlist, self.progress, 1, timeout=self.timeout)
+        timeout = self.get_timeout(rate)
+        d = probe.probe(mlist, self.progress, 1, timeout=timeout)
         return d[0]
 
+    def listen(self, rate):
+        try:
+            with serial.Serial('/dev/%s' % self.tty, rate,
+                               timeout=DETECT_TIME) as port:
+                return find_rtu_frame(port.read(256))
+        except serial.SerialException:
+            return None
+
+    def detect_rate(self, rates):
+        if self.tty in client.serial_ports:
+            return client.serial_ports[self.tty].baudrate
+
+        if self.tty in client.parent_ports:
+            return client.parent_ports[self.tty]
+
+        if self.mode != 'rtu' or len(rates) < 2:
+            return None
+
+        for r in rates:
+            if not self.running:
+                raise ScanAborted()
+
+            frame = self.listen(r)
+            if frame:
+                log.info('Detected traffic on %s @ %d bps: %s',
+                         self.tty, r, frame.hex())
+                return r
+
+        return None
+
+    def get_resume(self, rates):
+        try:
+            tty, rate, unit = self.resume.split(':')
+            rate = int(rate)
+            unit = int(unit)
+        except:
+            return None
+
+        if tty != self.tty or rate not in rates:
+            return None
+
+        return rate, unit
+
     def scan(self):
         units = probe.get_units(self.mode)
-        rates = self.rates or probe.get_rates(self.mode)
+        # configured rates are tried in the order given
+        rates = self.rates or sorted(probe.get_rates(self.mode))
+
+        rate = self.detect_rate(rates)
+        if rate:
+            rates = [rate]
 
         for r in rates:
             log.info('Scanning %s @ %d bps (quick)', self.tty, r)
@@ -172,18 +426,94 @@ class SerialScanner(Scanner):
                 rates = [r]
                 break
 
-        if not self.full:
+        resume = self.get_resume(rates)
+
+        if not self.full and not resume:
             return
 
         units = set(range(MODBUS_UNIT_MIN, MODBUS_UNIT_MAX + 1)) - \
             set(d.unit for d in found)
 
         for r in rates:
+            uu = units
+
+            if resume:
+                if rates.index(r) < rates.index(resume[0]):
+                    continue
+
+                log.info('Resuming scan of %s @ %d bps at unit %d',
+                         self.tty, *resume)
+                uu = set(u for u in units if u >= resume[1])
+                self.progress(len(units) - len(uu), None)
+                resume = None
+
             log.info('Scanning %s @ %d bps (full)', self.tty, r)
-            self.scan_units(units, r)
+            self.scan_units(uu, r, True)
 
-    def start(self):
+    def prepare(self):
         self.total = MODBUS_UNIT_MAX
+
+        if self.use_process:
+            client.share_port_lock(self.tty)
+
+    # the scan process must not use a port still warming up here
+    def wait_ready(self):
+        c = client.serial_ports.get(self.tty)
+        if c:
+            c.ready.wait()
+
+    def start(self):
+        self.prepare()
         return super().start()
 
-__all__ = ['NetScanner', 'SerialScanner']
+class MultiScanner(Scanner):
+    def __init__(self, scanners):
+        super().__init__()
+        self.scanners = scanners
+
+    def progress(self, n, dev):
+        self.cursor = ','.join(filter(None, (s.cursor for s in self.scanners)))
+        super().progress(n, dev)
+
+    def get_resume(self, scanner):
+        for r in (self.resume or '').split(','):
+            if r.startswith(scanner.tty + ':'):
+                return r
+
+        return None
+
+    def scan(self):
+        tasks = []
+
+        for s in self.scanners:
+            s.parent = self
+            s.done = 0
+            s.running = True
+            s.resume = self.get_resume(s)
+
+            t = threading.Thread(target=s.run)
+            t.start()
+            tasks.append(t)
+
+        for t in tasks:
+            t.join()
+
+    def start(self):
+        for s in self.scanners:
+            s.use_process = self.use_process
+            s.prepare()
+
+        self.total = sum(s.total for s in self.scanners)
+
+        return super().start()
+
+    def wait_ready(self):
+        for s in self.scanners:
+            s.wait_ready()
+
+    def stop(self):
+        for s in self.scanners:
+            s.stop()
+        super().stop()
+
+__all__ = ['MultiScanner', 'NetScanner', 'SerialScanner']
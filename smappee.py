@@ -98,7 +98,7 @@ class CurrentTransformer:
     def set_phase(self, n):
         v = 0 if n < 0 else 1 << int(n)
         self.phase = n
-        self.dev.write_register(self.regs[0], v)
+        self.dev.defer_write(self.dev.write_register, self.regs[0], v)
 
         if n >= 0:
             for ct in self.dev.all_cts:
@@ -252,7 +252,7 @@ class PowerBox(device.CustomName, device.EnergyMeter):
         time.sleep(0.25)
 
     def ct_identify(self, ct, path, val):
-        ct.identify(val)
+        self.defer_write(ct.identify, val)
         return False
 
     def device_init_late(self):
@@ -272,7 +272,12 @@ class PowerBox(device.CustomName, device.EnergyMeter):
         self.sched_reinit()
 
     def write_modbus(self, base, val):
-        self.modbus.write_registers(base, val, unit=self.unit)
+        rr = self.modbus.write_registers(base, val, unit=self.unit)
+
+        if rr.isError():
+            self.log.error('Error writing register %#04x: %s', base, rr)
+
+        return rr
 
 models = {
     5400: {
@@ -0,0 +1,116 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from register import *
+
+BATCH_MIN = 16
+
+# register type -> (numpy type, words, little-endian word order)
+reg_types = {
+    Reg_s16:    ('int16',   1, False),
+    Reg_u16:    ('uint16',  1, False),
+    Reg_s32b:   ('int32',   2, False),
+    Reg_u32b:   ('uint32',  2, False),
+    Reg_f32b:   ('float32', 2, False),
+    Reg_s32l:   ('int32',   2, True),
+    Reg_u32l:   ('uint32',  2, True),
+    Reg_f32l:   ('float32', 2, True),
+}
+
+class BlockDecoder:
+    def __init__(self, regs, dtype, words, little):
+        start = regs[0].base
+        pos = numpy.array([r.base - start for r in regs])
+
+        if words == 2 and little:
+            self.hi, self.lo = pos + 1, pos
+        elif words == 2:
+            self.hi, self.lo = pos, pos + 1
+        else:
+            self.hi, self.lo = None, pos
+
+        self.dtype = dtype
+        self.scale = numpy.array([float(r.scale) for r in regs])
+        self.isint = [isinstance(r.scale, int) for r in regs]
+        self.anyfloat = not all(self.isint)
+
+        # an invalid marker not representable in the type never matches
+        inv = [r.invalid[0] if r.invalid else 0 for r in regs]
+        self.inv = numpy.array(inv).astype(dtype)
+        self.has_inv = numpy.array([bool(r.invalid) for r in regs]) & \
+            (numpy.array(self.inv.tolist()) == numpy.array(inv))
+
+    def decode(self, values):
+        w = numpy.array(values, dtype='uint32')
+
+        if self.hi is None:
+            raw = w[self.lo].astype('uint16').view(self.dtype)
+        else:
+            raw = (w[self.hi] << 16 | w[self.lo]).view(self.dtype)
+
+        invalid = (self.has_inv & (raw == self.inv)).tolist()
+        ints = raw.tolist()
+
+        if self.anyfloat:
+            # NaN and infinite f32 payloads decode as such
+            with numpy.errstate(invalid='ignore', over='ignore'):
+                floats = (raw.astype('float64') / self.scale).tolist()
+        else:
+            floats = ints
+
+        return [None if inv else i if isint else f for i, f, isint, inv in
+                zip(ints, floats, self.isint, invalid)]
+
+def eligible(regs):
+    t = type(regs[0])
+
+    if t not in reg_types or len(regs) < BATCH_MIN:
+        return False
+
+    for r in regs:
+        if type(r) is not t or len(r.invalid) > 1:
+            return False
+
+    return True
+
+# Return a decoder converting all registers of a packed block at once,
+# or None if NumPy is unavailable or the block is not a run of at least
+# BATCH_MIN plain numeric registers of a single supported type.
+def make_decoder(regs):
+    if numpy is None or not eligible(regs):
+        return None
+
+    return BlockDecoder(regs, *reg_types[type(regs[0])])
+
+if __name__ == '__main__':
+    import random
+    import timeit
+
+    def bench(cls, n, scale):
+        regs = [cls(i * cls.count, '/R%d' % i, scale) for i in range(n)]
+        words = [random.randrange(0x10000) for i in range(n * cls.count)]
+        dec = BlockDecoder(regs, *reg_types[cls])
+
+        def py():
+            for r in regs:
+                r.decode(words[r.base:r.base + r.count])
+
+        def vec():
+            for r, v in zip(regs, dec.decode(words)):
+                r.update(v)
+
+        tp = min(timeit.repeat(py, number=1000, repeat=3))
+        tv = min(timeit.repeat(vec, number=1000, repeat=3))
+
+        print('%-10s %4d regs: python %7.1f us, numpy %7.1f us' %
+              (cls.__name__, n, 1000 * tp, 1000 * tv))
+
+    if numpy is None:
+        print('NumPy not available')
+    else:
+        for n in (8, 28, 60):
+            bench(Reg_u16, n, 1)
+            bench(Reg_s32b, n, 10)
+            bench(Reg_f32l, n, 1)
@@ -19,6 +19,7 @@ class VE_Meter(vreglink.VregLink, device.EnergyMeter):
                   'heatpump', 'acload', 'acload']
     allowed_roles = None
     refresh_time = 20
+    inplace_role_switch = False     # role is read from the meter
 
     def get_phases(self, cfg):
         if 0 <= cfg <= 2:
@@ -165,8 +166,8 @@ class VE_Meter(vreglink.VregLink, device.EnergyMeter):
             self.dbus.add_path('/PositionIsAdjustable', 0)
 
     def set_name(self, val):
-        self.vreglink_set(0x10c, bytes(val, encoding='utf-8'))
-        return True
+        return self.defer_write(self.vreglink_set, 0x10c,
+                                bytes(val, encoding='utf-8'))
 
     def name_changed(self, reg):
         self.dbus['/Devices/0/CustomName'] = reg.value
@@ -179,8 +180,8 @@ class VE_Meter(vreglink.VregLink, device.EnergyMeter):
         self.dbus['/Alarms/PhaseRotation'] = mapping[reg.value & 3]
 
     def set_systeminstance(self, val):
-        self.vreglink_set(0x112, int(val).to_bytes(1, 'little'))
-        return True
+        return self.defer_write(self.vreglink_set, 0x112,
+                                int(val).to_bytes(1, 'little'))
 
 class VE_Meter_A1B1(VE_Meter):
     productid = 0xa1b1
@@ -60,8 +60,8 @@ class VE_Meter_P1Link(VregLink, EnergyMeter):
             self.add_phase_regs(n)
 
     def set_name(self, val):
-        self.vreglink_set(0x10c, bytes(val, encoding='utf-8'))
-        return True
+        return self.defer_write(self.vreglink_set, 0x10c,
+                                bytes(val, encoding='utf-8'))
 
     def name_changed(self, reg):
         self.dbus['/Devices/0/CustomName'] = reg.value
@@ -34,6 +34,10 @@ class VregLink:
                            self.dbus['/FirmwareVersion'])
         self.dbus.add_path('/Devices/0/IpAddress', self.spec.target)
 
+    def rebind(self, dev):
+        super().rebind(dev)
+        self.dbus['/Devices/0/IpAddress'] = self.spec.target
+
     def vreglink_get(self, regid):
         return self.vreglink_exec(regid)
 